@@ -1 +1 @@
-from langid import classify, rank
+from langid import classify, rank, classify_stream, classify_early, classify_batch, rank_batch, set_languages, set_result_cache, load_model, get_identifier, LanguageIdentifier, MicroBatcher, enable_metrics
@@ -20,8 +20,10 @@ import optparse
 if __name__ == "__main__":
   parser = optparse.OptionParser()
   parser.add_option('-l', '--langs', dest='langs', help='comma-separated set of target ISO639 language codes (e.g en,de)')
+  parser.add_option('-c', '--cache', type='int', default=10000, help='number of results to cache for repeated messages (0 to disable)')
   opts, args = parser.parse_args()
 
+  langid.set_result_cache(opts.cache)
   lang_set = set(opts.langs.split(",")) if opts.langs else None
 
   try:
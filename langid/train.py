@@ -39,11 +39,14 @@ import array
 import numpy as np
 import multiprocessing as mp
 import tempfile
-import marshal
 import atexit, shutil
-from collections import deque, defaultdict
+import langid
+import itertools
+from collections import defaultdict
 from contextlib import closing
 
+STATES_16BIT = 1 << 16 # largest number of scanner states stored as 16-bit ids
+
 class Scanner(object):
   alphabet = map(chr, range(1<<8))
   """
@@ -58,64 +61,54 @@ class Scanner(object):
     return self.search(value)
 
   def build(self, keywords):
+    # Algorithm 2: build the trie. States are numbered in order of creation,
+    # and each records its parent, the letter leading to it, and its depth.
     goto = dict()
-    fail = dict()
     output = defaultdict(set)
-
-    # Algorithm 2
+    parent, letter, depth = [0], [0], [0]
     newstate = 0
     for a in keywords:
       state = 0
       j = 0
-      while (j < len(a)) and (state, a[j]) in goto:
-        state = goto[(state, a[j])]
+      while (j < len(a)) and (state << 8) + ord(a[j]) in goto:
+        state = goto[(state << 8) + ord(a[j])]
         j += 1
       for p in range(j, len(a)):
         newstate += 1
-        goto[(state, a[p])] = newstate
-        #print "(%d, %s) -> %d" % (state, a[p], newstate)
+        goto[(state << 8) + ord(a[p])] = newstate
+        parent.append(state)
+        letter.append(ord(a[p]))
+        depth.append(p + 1)
         state = newstate
       output[state].add(a)
-    for a in self.alphabet:
-      if (0,a) not in goto: 
-        goto[(0,a)] = 0
-
-    # Algorithm 3
-    queue = deque()
-    for a in self.alphabet:
-      if goto[(0,a)] != 0:
-        s = goto[(0,a)]
-        queue.append(s)
-        fail[s] = 0
-    while queue:
-      r = queue.popleft()
-      for a in self.alphabet:
-        if (r,a) in goto:
-          s = goto[(r,a)]
-          queue.append(s)
-          state = fail[r]
-          while (state,a) not in goto:
-            state = fail[state]
-          fail[s] = goto[(state,a)]
-          #print "f(%d) -> %d" % (s, goto[(state,a)]), output[fail[s]]
-          if output[fail[s]]:
-            output[s].update(output[fail[s]])
-
-    # Algorithm 4
-    self.nextmove = {}
-    for a in self.alphabet:
-      self.nextmove[(0,a)] = goto[(0,a)]
-      if goto[(0,a)] != 0:
-        queue.append(goto[(0,a)])
-    while queue:
-      r = queue.popleft()
-      for a in self.alphabet:
-        if (r,a) in goto:
-          s = goto[(r,a)]
-          queue.append(s)
-          self.nextmove[(r,a)] = s
-        else:
-          self.nextmove[(r,a)] = self.nextmove[(fail[r],a)]
+    num_states = newstate + 1
+    parent = np.array(parent, dtype=int)
+    letter = np.array(letter, dtype=int)
+    depth = np.array(depth, dtype=int)
+
+    # Algorithms 3 and 4: compute the failure function and the full
+    # transition table together, one level of the trie at a time. The row
+    # of a state is the row of its failure state, overridden by the goto
+    # function of the state itself. Failure states are always shallower,
+    # so their rows are complete by the time they are needed.
+    fail = np.zeros(num_states, dtype=np.int32)
+    nextmove = np.zeros((num_states, len(self.alphabet)), dtype=np.int32)
+    levels = [np.flatnonzero(depth == d) for d in xrange(depth.max() + 1)]
+    for d, states in enumerate(levels):
+      if d > 1:
+        fail[states] = nextmove[fail[parent[states]], letter[states]]
+      if d > 0:
+        nextmove[states] = nextmove[fail[states]]
+      if d + 1 < len(levels):
+        children = levels[d + 1]
+        nextmove[parent[children], letter[children]] = children
+
+    # Accumulate the output of each state's failure state. This is done in
+    # breadth-first order so that the output of the failure state is complete.
+    for states in levels[2:]:
+      for s, f in itertools.izip(states.tolist(), fail[states].tolist()):
+        if output[f]:
+          output[s].update(output[f])
 
     # convert the output to tuples, as tuple iteration is faster
     # than set iteration
@@ -123,12 +116,11 @@ class Scanner(object):
 
     # Next move encoded as a single array. The index of the next state
     # is located at current state * alphabet size  + ord(c).
-    # The choice of 'H' array typecode limits us to 64k states.
-    def nextstate_iter():
-      for state in xrange(len(set(self.nextmove.values()))):
-        for letter in self.alphabet:
-          yield self.nextmove[(state, letter)]
-    self.nm_arr = array.array('H', nextstate_iter())
+    # States are stored as 16-bit ids where they fit, and as 32-bit ids
+    # for scanners with more than 64k states.
+    typecode = 'H' if num_states <= STATES_16BIT else 'I'
+    self.nm_arr = array.array(typecode)
+    self.nm_arr.fromstring(nextmove.astype(np.dtype(typecode)).tostring())
 
   def __getstate__(self):
     """
@@ -140,17 +132,11 @@ class Scanner(object):
     nm_array, output = value
     self.nm_arr = nm_array
     self.output = output
-    self.nextmove = {}
-    for i, next_state in enumerate(nm_array):
-      state = i / 256
-      letter = chr(i % 256)
-      self.nextmove[(state, letter)] = next_state 
 
   def search(self, string):
-    # TODO: update to using nm_arr
     state = 0
     for letter in string:
-      state = self.nextmove[(state, letter)]
+      state = self.nm_arr[(state << 8) + ord(letter)]
       for key in self.output.get(state, []):
         yield key
 
@@ -173,16 +159,16 @@ def offsets(chunks):
   return chunk_offsets
 
 
-def unmarshal_iter(path):
+# Bucket files hold the (f_id, chunk_id, doc_id, count) items of a single
+# pass1 chunk as four consecutive int32 columns of equal length.
+BUCKET_DTYPE = '<i4'
+
+def read_bucket(path):
   """
-  Open a given path and yield an iterator over items unmarshalled from it.
+  Read the items in a bucket file.
+  @returns the f_id, chunk_id, doc_id and count columns as arrays
   """
-  with open(path, 'rb') as f:
-    while True:
-      try:
-        yield marshal.load(f)
-      except EOFError:
-        break
+  return np.fromfile(path, dtype=BUCKET_DTYPE).reshape(4, -1)
 
 def index(seq):
   """
@@ -194,11 +180,13 @@ def index(seq):
   return dict((k,v) for (v,k) in enumerate(seq))
 
 
-def setup_pass1(nm_arr, output_states, state2feat, b_dirs, bucket_map):
+def setup_pass1(bytemap, nm_arr, output_states, state2feat, b_dirs, bucket_map):
   """
-  Set the global next-move array used by the aho-corasick scanner
+  Set the global byte class map and next-move array used by the aho-corasick scanner
   """
-  global __nm_arr, __output_states, __state2feat, __b_dirs, __bucket_map
+  global __bytemap, __num_byteclasses, __nm_arr, __output_states, __state2feat, __b_dirs, __bucket_map
+  __bytemap = bytemap
+  __num_byteclasses = ord(max(bytemap)) + 1
   __nm_arr = nm_arr
   __output_states = output_states
   __state2feat = state2feat
@@ -210,13 +198,13 @@ def state_trace(path):
   """
   Returns counts of how often each state was entered
   """
-  global __nm_arr
+  global __bytemap, __num_byteclasses, __nm_arr
   c = defaultdict(int)
   state = 0
   with open(path) as f:
-    text = f.read()
+    text = f.read().translate(__bytemap)
     for letter in map(ord,text):
-      state = __nm_arr[(state << 8) + letter]
+      state = __nm_arr[state * __num_byteclasses + letter]
       c[state] += 1
   return c
 
@@ -229,7 +217,6 @@ def pass1(arg):
   chunk_id, chunk_paths = arg
   term_freq = defaultdict(int)
   __procname = mp.current_process().name
-  __buckets = [tempfile.mkstemp(prefix=__procname, suffix='.index', dir=p)[0] for p in __b_dirs]
 
   for doc_id, path in enumerate(chunk_paths):
     count = state_trace(path)
@@ -237,63 +224,70 @@ def pass1(arg):
       for f_id in __state2feat[state]:
         term_freq[doc_id, f_id] += count[state]
 
-  for doc_id, f_id in term_freq:
-    bucket_index = __bucket_map[f_id]
-    count = term_freq[doc_id, f_id]
-    item = ( f_id, chunk_id, doc_id, count )
-    os.write(__buckets[bucket_index], marshal.dumps(item))
-
-  for f in __buckets:
-    os.close(f)
+  # Group the items by bucket, and write each bucket as a single block
+  doc_ids, f_ids = np.array(term_freq.keys(), dtype=BUCKET_DTYPE).reshape(-1, 2).T
+  counts = np.array(term_freq.values(), dtype=BUCKET_DTYPE)
+  bucket_ids = __bucket_map[f_ids]
+  order = np.argsort(bucket_ids, kind='mergesort')
+  bounds = np.searchsorted(bucket_ids[order], np.arange(len(__b_dirs) + 1))
+  for bucket_index, b_dir in enumerate(__b_dirs):
+    items = order[bounds[bucket_index]:bounds[bucket_index+1]]
+    if len(items) == 0:
+      continue
+    chunk_ids = np.empty(len(items), dtype=BUCKET_DTYPE)
+    chunk_ids.fill(chunk_id)
+    block = np.concatenate((f_ids[items], chunk_ids, doc_ids[items], counts[items]))
+    with os.fdopen(tempfile.mkstemp(prefix=__procname, suffix='.index', dir=b_dir)[0], 'wb') as f:
+      block.tofile(f)
 
   return len(term_freq)
 
-def setup_pass2(cm, chunk_offsets, num_instances):
-  global __cm, __chunk_offsets, __num_instances
+def setup_pass2(cm, num_classes, chunk_offsets):
+  global __cm, __num_classes, __chunk_offsets
   __cm = cm
-  __chunk_offsets = chunk_offsets
-  __num_instances = num_instances
+  __num_classes = num_classes
+  __chunk_offsets = np.array(chunk_offsets)
 
 def pass2(arg):
   """
-  Take a bucket, form a feature map, learn the nb_ptc for it.
+  Take a bucket, and count the occurrences of its features in each class.
+  The counts are accumulated directly from the items in the bucket, so
+  memory use does not depend on the number of documents.
   """
-  global __cm, __chunk_offsets, __num_instances
+  global __cm, __num_classes, __chunk_offsets
   num_feats, base_f_id, b_dir = arg
-  fm = np.zeros((__num_instances, num_feats), dtype='int')
+  prod = np.zeros((num_feats, __num_classes), dtype='int')
 
   read_count = 0
   for path in os.listdir(b_dir):
     if path.endswith('.index'):
-      for f_id, chunk_id, doc_id, count in unmarshal_iter(os.path.join(b_dir, path)):
-        doc_index = __chunk_offsets[chunk_id] + doc_id
-        f_index = f_id - base_f_id
-        fm[doc_index, f_index] = count
-        read_count += 1
+      f_id, chunk_id, doc_id, count = read_bucket(os.path.join(b_dir, path))
+      cells = (f_id - base_f_id) * __num_classes + __cm[__chunk_offsets[chunk_id] + doc_id]
+      prod += np.bincount(cells, weights=count, minlength=prod.size).astype('int').reshape(prod.shape)
+      read_count += len(count)
 
-  prod = np.dot(fm.T, __cm)
   return read_count, prod
 
 
-def learn_pc(cm):
+def learn_pc(cm, num_classes):
   """
   @param cm class map
+  @param num_classes number of classes
   @returns nb_pc: log(P(C))
   """
-  pc = np.log(cm.sum(0))
+  pc = np.log(np.bincount(cm, minlength=num_classes))
   nb_pc = array.array('d', pc)
   return nb_pc
 
 def generate_cm(paths, langs):
   num_instances = len(paths)
-  num_classes = len(langs)
 
-  # Generate the class map
+  # Generate the class map, which holds the class index of each document
   lang_index = index(sorted(langs))
-  cm = np.zeros((num_instances, num_classes), dtype='bool')
+  cm = np.zeros((num_instances,), dtype='int32')
   for docid, path in enumerate(paths):
     lang = os.path.basename(os.path.dirname(path))
-    cm[docid, lang_index[lang]] = True
+    cm[docid] = lang_index[lang]
   nb_classes = sorted(lang_index, key=lang_index.get)
   print "generated class map"
 
@@ -310,12 +304,12 @@ def cleanup():
     pass
 
 FEATS_PER_CHUNK = 100
-def generate_ptc(paths, nb_features, tk_nextmove, state2feat, cm):
+def generate_ptc(paths, nb_features, tk_byteclass, tk_nextmove, state2feat, cm, num_classes):
   global b_dirs
-  num_instances = len(paths)
   num_features = len(nb_features)
 
   # Generate the feature map
+  bytemap = tk_byteclass.tostring()
   nm_arr = mp.Array('i', tk_nextmove, lock=False)
 
   chunk_size = min(len(paths) / (options.job_count*2), 100)
@@ -324,7 +318,7 @@ def generate_ptc(paths, nb_features, tk_nextmove, state2feat, cm):
 
   feat_index = index(nb_features)
 
-  bucket_map = {}
+  bucket_map = np.zeros(num_features, dtype=int)
   b_dirs = []
   for chunk_id, feat_chunk in enumerate(feat_chunks):
     for feat in feat_chunk:
@@ -334,7 +328,7 @@ def generate_ptc(paths, nb_features, tk_nextmove, state2feat, cm):
 
 
   output_states = set(state2feat)
-  with closing( mp.Pool(options.job_count, setup_pass1, (nm_arr, output_states, state2feat, b_dirs, bucket_map)) 
+  with closing( mp.Pool(options.job_count, setup_pass1, (bytemap, nm_arr, output_states, state2feat, b_dirs, bucket_map)) 
               ) as pool:
     pass1_out = pool.imap_unordered(pass1, enumerate(path_chunks))
   pool.join()
@@ -344,7 +338,7 @@ def generate_ptc(paths, nb_features, tk_nextmove, state2feat, cm):
 
   f_chunk_sizes = map(len, feat_chunks)
   f_chunk_offsets = offsets(feat_chunks)
-  with closing( mp.Pool(options.job_count, setup_pass2, (cm, offsets(path_chunks), num_instances)) 
+  with closing( mp.Pool(options.job_count, setup_pass2, (cm, num_classes, offsets(path_chunks))) 
               ) as pool:
     pass2_out = pool.imap(pass2, zip(f_chunk_sizes, f_chunk_offsets, b_dirs))
   pool.join()
@@ -379,7 +373,12 @@ def build_scanner(nb_features):
   # Build the actual scanner
   print "building scanner"
   scanner = Scanner(nb_features)
-  tk_nextmove, raw_output = scanner.__getstate__()
+  nm_arr, raw_output = scanner.__getstate__()
+  byteclass, nextmove = langid.byte_classes(np.frombuffer(nm_arr, dtype=nm_arr.typecode))
+  tk_byteclass = array.array('B', byteclass.tostring())
+  tk_nextmove = array.array(nm_arr.typecode, nextmove.tostring())
+  num_byteclasses = max(tk_byteclass) + 1
+  print "scanner has %d states over %d byte classes" % (len(tk_nextmove) / num_byteclasses, num_byteclasses)
 
   # tk_output is the output function of the scanner. It should generate indices into
   # the feature space directly, as this saves a lookup
@@ -391,7 +390,7 @@ def build_scanner(nb_features):
   state2feat = {}
   for k,v in raw_output.items():
     state2feat[k] = tuple(feat_index[f] for f in v)
-  return tk_nextmove, tk_output, state2feat
+  return tk_byteclass, tk_nextmove, tk_output, state2feat
 
 if __name__ == "__main__":
   parser = optparse.OptionParser()
@@ -400,6 +399,7 @@ if __name__ == "__main__":
   parser.add_option("-i","--input", dest="infile", help="read features from FILE", metavar="FILE")
   parser.add_option("-j","--jobs", dest="job_count", type="int", help="number of processes to use", default=mp.cpu_count())
   parser.add_option("-t","--temp",dest="temp", help="store temporary files in DIR", metavar="DIR", default=tempfile.gettempdir())
+  parser.add_option("-b","--binary",action="store_true", default=False, help="output the model in binary format")
   options, args = parser.parse_args()
   
   tempfile.tempdir = options.temp
@@ -407,13 +407,18 @@ if __name__ == "__main__":
   paths, langs = read_corpus(options.corpus)
   nb_features = map(eval, open(options.infile))
   nb_classes, cm = generate_cm(paths, langs)
-  tk_nextmove, tk_output, state2feat = build_scanner(nb_features)
-  nb_ptc = generate_ptc(paths, nb_features, tk_nextmove, state2feat, cm)
-  nb_pc = learn_pc(cm)
+  tk_byteclass, tk_nextmove, tk_output, state2feat = build_scanner(nb_features)
+  nb_ptc = generate_ptc(paths, nb_features, tk_byteclass, tk_nextmove, state2feat, cm, len(nb_classes))
+  nb_pc = learn_pc(cm, len(nb_classes))
 
   # output the model
-  model = nb_ptc, nb_pc, nb_classes, tk_nextmove, tk_output
-  string = base64.b64encode(bz2.compress(cPickle.dumps(model)))
-  with open(options.outfile, 'w') as f:
-    f.write(string)
-  print "wrote model to %s (%d bytes)" % (options.outfile, len(string))
+  model = nb_ptc, nb_pc, nb_classes, tk_byteclass, tk_nextmove, tk_output
+  if options.binary:
+    langid.LanguageIdentifier.from_model(model).write_binary(options.outfile)
+    size = os.path.getsize(options.outfile)
+  else:
+    string = base64.b64encode(bz2.compress(cPickle.dumps(model)))
+    with open(options.outfile, 'w') as f:
+      f.write(string)
+    size = len(string)
+  print "wrote model to %s (%d bytes)" % (options.outfile, size)
@@ -0,0 +1,311 @@
+"""
+Regression checks for the tokenizer, scanner, binary model format and
+streaming classification. Run with:
+
+  python tests/test_langid.py
+"""
+import os, sys
+import array
+import random
+import shutil
+import tempfile
+import unittest
+import multiprocessing as mp
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+from langid import langid, train
+
+def random_text(rng, alphabet, length):
+  return ''.join(rng.choice(alphabet) for i in xrange(length))
+
+def build_identifier(features, num_classes=2):
+  """
+  Build an identifier over features, with the scanner train.py would build
+  and a random model.
+  """
+  rng = np.random.RandomState(0)
+  tk_byteclass, tk_nextmove, tk_output, state2feat = train.build_scanner(features)
+  nb_ptc = array.array('d', np.log(rng.uniform(size=len(features) * num_classes)))
+  nb_pc = array.array('d', np.log(np.ones(num_classes) / num_classes))
+  nb_classes = ['c%d' % i for i in xrange(num_classes)]
+  model = nb_ptc, nb_pc, nb_classes, tk_byteclass, tk_nextmove, tk_output
+  return langid.LanguageIdentifier.from_model(model)
+
+def search_fv(scanner, features, text):
+  """
+  The feature vector of text according to train.Scanner.search.
+  """
+  index = dict((f, i) for i, f in enumerate(features))
+  fv = np.zeros(len(features), dtype=int)
+  for feat in scanner.search(text):
+    fv[index[feat]] += 1
+  return fv
+
+def substring_fv(features, text):
+  """
+  The feature vector of text by counting the occurrences of each feature.
+  """
+  fv = np.zeros(len(features), dtype=int)
+  for i, feat in enumerate(features):
+    start = text.find(feat)
+    while start != -1:
+      fv[i] += 1
+      start = text.find(feat, start + 1)
+  return fv
+
+class ScannerTest(unittest.TestCase):
+  def check_scanner(self, features, alphabet):
+    rng = random.Random(1)
+    scanner = train.Scanner(features)
+    num_states = 1 + len(set(f[:i] for f in features for i in xrange(1, len(f) + 1)))
+    self.assertEqual(len(scanner.nm_arr), num_states * 256)
+    for length in (0, 1, 5, 50, 500):
+      text = random_text(rng, alphabet, length)
+      self.assertTrue((search_fv(scanner, features, text) == substring_fv(features, text)).all())
+
+  def test_small(self):
+    self.check_scanner(['ab', 'b', 'abc', 'bc', 'c', 'cab'], 'abcd')
+
+  def test_every_lead_byte(self):
+    # no move leads back to the start state
+    features = [chr(i) for i in xrange(256)] + ['ab', 'ba', 'aba']
+    self.check_scanner(features, 'abc\0\xff')
+
+  def test_wide_states(self):
+    rng = random.Random(2)
+    # more than 64k states
+    features = list(set(random_text(rng, 'abcdefghijklmnopqrstuvwxyz', rng.randint(6, 9))
+        for i in xrange(15000)))
+    scanner = train.Scanner(features)
+    self.assertEqual(scanner.nm_arr.typecode, 'I')
+    text = ''.join(rng.choice(features) for i in xrange(200))
+    self.assertTrue((search_fv(scanner, features, text) == substring_fv(features, text)).all())
+
+class TokenizerTest(unittest.TestCase):
+  def setUp(self):
+    rng = random.Random(3)
+    self.alphabet = 'abcde \xc3\xa9'
+    self.features = list(set(random_text(rng, self.alphabet, rng.randint(1, 4)) for i in xrange(300)))
+    self.scanner = train.Scanner(self.features)
+    self.identifier = build_identifier(self.features)
+    self.texts = [''] + [random_text(rng, self.alphabet, n) for n in (1, 3, 10, 100, 1000, 5000)]
+
+  def test_tokenize(self):
+    for text in self.texts:
+      expected = search_fv(self.scanner, self.features, text)
+      self.assertTrue((self.identifier.instance2fv(text) == expected).all())
+      indices, counts = self.identifier.instance2sfv(text)
+      fv = np.zeros(len(self.features), dtype=int)
+      fv[indices] = counts
+      self.assertTrue((fv == expected).all())
+
+  def test_tokenize_chunks(self):
+    # texts longer than a tokenizer chunk are scanned in several chunks
+    rng = random.Random(4)
+    text = random_text(rng, self.alphabet, 3 * langid.TOKENIZE_CHUNK + 17)
+    expected = search_fv(self.scanner, self.features, text)
+    self.assertTrue((self.identifier.instance2fv(text) == expected).all())
+
+  def test_tokenize_batch(self):
+    batch = self.identifier.tokenize_sparse_batch(self.texts[:5] * 3)
+    for text, (indices, counts) in zip(self.texts[:5] * 3, batch):
+      fv = np.zeros(len(self.features), dtype=int)
+      fv[indices] = counts
+      self.assertTrue((fv == search_fv(self.scanner, self.features, text)).all())
+
+  def test_builtin_model(self):
+    # compare with walking the DFA of the built-in model one byte at a time
+    identifier = langid.get_identifier()
+    text = open(os.path.join(os.path.dirname(__file__), '..', 'README')).read()[:5000]
+    statecount = np.zeros(len(identifier.tk_output_ptr) - 1, dtype=int)
+    state = 0
+    for letter in text:
+      state = identifier.tk_nextmove[state * identifier.tk_numbyteclasses +
+          identifier.tk_byteclass[ord(letter)]]
+      statecount[state] += 1
+    expected = np.zeros(identifier.nb_numfeats, dtype=int)
+    for state in np.flatnonzero(statecount):
+      feats = identifier.tk_output_idx[identifier.tk_output_ptr[state]:identifier.tk_output_ptr[state+1]]
+      expected[feats] += statecount[state]
+    self.assertTrue((identifier.instance2fv(text) == expected).all())
+
+class BinaryModelTest(unittest.TestCase):
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def check_round_trip(self, identifier, texts):
+    path = os.path.join(self.tempdir, 'model.bin')
+    identifier.write_binary(path)
+    loaded = langid.LanguageIdentifier.from_modelpath(path)
+    self.assertEqual(loaded.nb_classes, identifier.nb_classes)
+    self.assertEqual(loaded.tk_depth, identifier.tk_depth)
+    for name in ('nb_ptc', 'nb_pc', 'tk_byteclass', 'tk_nextmove', 'tk_output_ptr', 'tk_output_idx'):
+      self.assertTrue((getattr(loaded, name) == getattr(identifier, name)).all(), name)
+    for text in texts:
+      self.assertEqual(loaded.rank(text), identifier.rank(text))
+
+  def test_builtin_model(self):
+    self.check_round_trip(langid.get_identifier(), ['', 'hello world', 'Das ist ein Satz.'])
+
+  def test_restricted_view(self):
+    # a restricted view writes the full model
+    identifier = langid.get_identifier()
+    path = os.path.join(self.tempdir, 'model.bin')
+    identifier.restrict(['en', 'de']).write_binary(path)
+    loaded = langid.LanguageIdentifier.from_binary(path)
+    self.assertEqual(loaded.nb_classes, identifier.nb_classes)
+
+  def test_trained_model(self):
+    rng = random.Random(5)
+    features = list(set(random_text(rng, 'abcdef', rng.randint(1, 5)) for i in xrange(500)))
+    self.check_round_trip(build_identifier(features, 3), [random_text(rng, 'abcdef', 200)])
+
+  def test_rewrite_in_place(self):
+    # writing a model over the file it was loaded from leaves the loaded
+    # model intact
+    rng = random.Random(6)
+    features = list(set(random_text(rng, 'abcdef', rng.randint(1, 5)) for i in xrange(500)))
+    texts = [random_text(rng, 'abcdef', 200) for i in xrange(3)]
+    identifier = build_identifier(features, 3)
+    path = os.path.join(self.tempdir, 'model.bin')
+    identifier.write_binary(path)
+    loaded = langid.LanguageIdentifier.from_binary(path)
+    loaded.write_binary(path)
+    self.assertEqual(os.listdir(self.tempdir), ['model.bin'])
+    reloaded = langid.LanguageIdentifier.from_binary(path)
+    for text in texts:
+      self.assertEqual(loaded.rank(text), identifier.rank(text))
+      self.assertEqual(reloaded.rank(text), identifier.rank(text))
+
+  def test_not_binary(self):
+    path = os.path.join(self.tempdir, 'model.bin')
+    with open(path, 'wb') as f:
+      f.write('not a model')
+    self.assertRaises(ValueError, langid.LanguageIdentifier.from_binary, path)
+
+class TrainTest(unittest.TestCase):
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def test_passes(self):
+    # the term-class counts of pass1 and pass2 match fm.T . one_hot(cm)
+    rng = random.Random(7)
+    features = list(set(random_text(rng, 'abcd', rng.randint(1, 3)) for i in xrange(40)))
+    for lang, alphabet in (('xx', 'abc'), ('yy', 'bcd'), ('zz', 'abcd ')):
+      os.mkdir(os.path.join(self.tempdir, lang))
+      for i in xrange(4):
+        with open(os.path.join(self.tempdir, lang, str(i)), 'wb') as f:
+          f.write(random_text(rng, alphabet, rng.randint(0, 60)))
+    paths, langs = train.read_corpus(self.tempdir)
+    nb_classes, cm = train.generate_cm(paths, langs)
+
+    tk_byteclass, tk_nextmove, tk_output, state2feat = train.build_scanner(features)
+    path_chunks = list(train.chunk(paths, 5))
+    feat_chunks = list(train.chunk(features, 7))
+    feat_index = train.index(features)
+    bucket_map = np.zeros(len(features), dtype=int)
+    b_dirs = []
+    for chunk_id, feat_chunk in enumerate(feat_chunks):
+      for feat in feat_chunk:
+        bucket_map[feat_index[feat]] = chunk_id
+      b_dirs.append(tempfile.mkdtemp(dir=self.tempdir))
+
+    train.setup_pass1(tk_byteclass.tostring(), mp.Array('i', tk_nextmove, lock=False),
+        set(state2feat), state2feat, b_dirs, bucket_map)
+    write_count = sum(map(train.pass1, enumerate(path_chunks)))
+    train.setup_pass2(cm, len(nb_classes), train.offsets(path_chunks))
+    reads, prods = zip(*map(train.pass2, zip(map(len, feat_chunks), train.offsets(feat_chunks), b_dirs)))
+    self.assertEqual(sum(reads), write_count)
+
+    fm = np.array([substring_fv(features, open(path).read()) for path in paths])
+    one_hot = np.zeros((len(paths), len(nb_classes)), dtype=int)
+    one_hot[np.arange(len(paths)), cm] = 1
+    self.assertTrue((np.vstack(prods) == fm.T.dot(one_hot)).all())
+    self.assertTrue((np.array(train.learn_pc(cm, len(nb_classes))) == np.log(one_hot.sum(0))).all())
+
+class StreamTest(unittest.TestCase):
+  def setUp(self):
+    self.identifier = langid.get_identifier()
+    self.text = open(os.path.join(os.path.dirname(__file__), '..', 'README')).read()[:3000]
+
+  def test_chunk_boundaries(self):
+    expected = self.identifier.classprobs(self.text)
+    for size in (1, 2, 3, 7, 100, 1000):
+      stream = self.identifier.stream()
+      for start in xrange(0, len(self.text), size):
+        stream.update(self.text[start:start+size])
+      self.assertTrue(np.allclose(stream.classprobs(), expected), size)
+
+  def test_classify_stream(self):
+    expected = self.identifier.classify(self.text)
+    for size in (5, 64, 4096):
+      result = self.identifier.classify_stream(StringIO(self.text), chunk_size=size)
+      self.assertEqual(result[0], expected[0])
+      self.assertAlmostEqual(result[1], expected[1])
+
+  def test_paths(self):
+    # small files are scored together, and the others are streamed
+    tempdir = tempfile.mkdtemp()
+    saved = langid.STREAM_CHUNK, langid.BATCH_READ_BYTES
+    try:
+      langid.STREAM_CHUNK, langid.BATCH_READ_BYTES = 1000, 2000
+      paths = []
+      for i, size in enumerate((0, 10, 999, 1000, 1001, 3000, 500, 800)):
+        paths.append(os.path.join(tempdir, str(i)))
+        with open(paths[-1], 'wb') as f:
+          f.write(self.text[:size])
+      texts = [open(path).read() for path in paths]
+      results, num_bytes = langid.cl_paths(paths)
+      self.assertEqual(num_bytes, sum(len(text) for text in texts))
+      self.assertEqual([path for path, retval in results], paths)
+      for (path, retval), text in zip(results, texts):
+        self.assertEqual(retval[0], self.identifier.classify(text)[0])
+        self.assertAlmostEqual(retval[1], self.identifier.classify(text)[1])
+      results, num_bytes = langid.cl_paths(paths, dist=True)
+      for (path, retval), text in zip(results, texts):
+        self.assertEqual([lang for lang, score in retval],
+            [lang for lang, score in self.identifier.rank(text)])
+      results, num_bytes = langid.cl_paths(paths, dist=True, max_bytes=100)
+      for (path, retval), text in zip(results, texts):
+        self.assertEqual([lang for lang, score in retval],
+            [lang for lang, score in self.identifier.rank(text[:100])])
+    finally:
+      langid.STREAM_CHUNK, langid.BATCH_READ_BYTES = saved
+      shutil.rmtree(tempdir)
+
+  def test_batch(self):
+    texts = ['', 'hello world', u'caf\xe9 au lait', self.text, 'x' * 10]
+    self.assertEqual(list(self.identifier.classify_batch(texts, 2)),
+        [self.identifier.classify(text) for text in texts])
+
+class ModuleTest(unittest.TestCase):
+  def tearDown(self):
+    langid.load_model()
+
+  def test_set_languages(self):
+    langid.load_model()
+    langid.set_languages(['en', 'de'])
+    self.assertEqual(sorted(langid.nb_classes), ['de', 'en'])
+    self.assertTrue(langid.nb_ptc is langid.identifier.nb_ptc)
+    self.assertEqual(langid.nb_ptc.shape, (langid.nb_numfeats, 2))
+    self.assertEqual(langid.classify('This is a test')[0], 'en')
+
+    # a view that shares the full nb_ptc leaves the legacy global unset
+    # rather than copying its columns
+    langid.identifier.subset_cache.max_bytes = 0
+    langid.set_languages(['en', 'de', 'fr'])
+    self.assertTrue(langid.nb_ptc is None)
+    self.assertEqual(sorted(langid.nb_classes), ['de', 'en', 'fr'])
+    self.assertEqual(langid.classify('This is a test')[0], 'en')
+
+if __name__ == "__main__":
+  unittest.main()